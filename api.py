@@ -1,12 +1,15 @@
-from datetime import datetime
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, Depends, Query
-from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy import desc, create_engine
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import func, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 import os
-from bot import Log
+from models import Log, ENGINE_OPTIONS, async_database_url
 from dotenv import load_dotenv
 import logging
 
@@ -18,85 +21,226 @@ logger = logging.getLogger("api_logger")
 
 # Настройка БД
 DATABASE_URL = os.getenv('DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# API только читает логи: AUTOCOMMIT избавляет от BEGIN/COMMIT на каждый запрос
+engine = create_async_engine(async_database_url(DATABASE_URL), isolation_level='AUTOCOMMIT', **ENGINE_OPTIONS)
+SessionRO = async_sessionmaker(engine, autoflush=False)
+
+# До какой оценки планировщика число записей считается точным COUNT(*)
+EXACT_COUNT_THRESHOLD = 10_000
+# Максимальная ширина интервала start_date - end_date
+MAX_DATE_RANGE = timedelta(days=90)
+# Страницы логов можно кэшировать в браузере и прокси, актуальность проверяется по ETag
+CACHE_CONTROL = 'public, max-age=60, stale-while-revalidate=300'
+
+# Поля, которые можно запросить через параметр fields. id и timestamp выбираются всегда: на них строится курсор
+LOG_FIELDS = {
+    'id': Log.id,
+    'user_id': Log.user_id,
+    'command': Log.command,
+    'timestamp': Log.timestamp,
+    'response': Log.response,
+}
 
 
 class LogSchema(BaseModel):
     """ Модель Pydantic """
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
-    user_id: int
-    command: str
+    user_id: Optional[int] = None
+    command: Optional[str] = None
+    timestamp: datetime
+    response: Optional[str] = None
+
+
+# Валидация всей страницы логов одним вызовом pydantic-core вместо построчного from_orm.
+# Это единственная валидация: эндпоинты отдают готовую страницу через ORJSONResponse без response_model
+LOGS_ADAPTER = TypeAdapter(List[LogSchema])
+
+
+class LogCursor(BaseModel):
+    """ Курсор для получения следующей страницы логов """
     timestamp: datetime
-    response: str
+    id: int
+
 
-    class Config:
-        orm_mode = True
+class LogPage(BaseModel):
+    """ Страница логов с курсором на следующую страницу """
+    items: List[LogSchema]
+    total_estimate: int
+    next_cursor: Optional[LogCursor] = None
 
 
 app = FastAPI(
     title='Weather Bot Logs API',
     description='API для просмотра истории запросов пользователей Telegram-бота погоды.',
     version='1.0.0',
+    default_response_class=ORJSONResponse,
 )
 
 
 # Зависимость для получения сессии базы данных
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionRO() as db:
         yield db
-    finally:
-        db.close()
 
 
-@app.get('/logs', response_model=List[LogSchema], summary="Получить все логи",
+async def estimate_total(db: AsyncSession, query) -> int:
+    """ Общее число записей: оценка планировщика, точный COUNT(*) только для небольших выборок """
+    if query.whereclause is None:
+        # Без фильтров хватает статистики таблицы, COUNT(*) прошёл бы по всей таблице
+        result = await db.execute(text("SELECT reltuples::bigint FROM pg_class WHERE relname = 'logs'"))
+        return max(result.scalar() or 0, 0)
+
+    compiled = query.compile(dialect=db.bind.dialect, compile_kwargs={'literal_binds': True})
+    result = await db.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}"))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    if estimate > EXACT_COUNT_THRESHOLD:
+        return estimate
+
+    result = await db.execute(select(func.count()).select_from(query.subquery()))
+    return result.scalar()
+
+
+async def paginate(db: AsyncSession, query, before_ts: Optional[datetime], before_id: Optional[int], limit: int) -> LogPage:
+    """ Keyset-пагинация по (timestamp, id): страница начинается сразу после курсора """
+    total_estimate = await estimate_total(db, query)
+    if before_ts is not None and before_id is not None:
+        query = query.where(tuple_(Log.timestamp, Log.id) < tuple_(before_ts, before_id))
+    result = await db.execute(query.order_by(Log.timestamp.desc(), Log.id.desc()).limit(limit))
+    logs = LOGS_ADAPTER.validate_python(result.all(), from_attributes=True)
+    next_cursor = None
+    if len(logs) == limit:
+        next_cursor = LogCursor(timestamp=logs[-1].timestamp, id=logs[-1].id)
+    return LogPage(items=logs, total_estimate=total_estimate, next_cursor=next_cursor)
+
+
+def page_response(page: LogPage, etag: str) -> ORJSONResponse:
+    """ Ответ со страницей логов: невыбранные через fields поля не попадают в JSON """
+    return ORJSONResponse(page.model_dump(exclude_unset=True), headers={'ETag': etag, 'Cache-Control': CACHE_CONTROL})
+
+
+async def page_etag(db: AsyncSession, request: Request, user_id: Optional[int] = None) -> str:
+    """ ETag страницы: параметры запроса, время и ID последней записи.
+    ID растёт с каждым новым логом, даже если его timestamp совпадает с предыдущим или меньше него.
+    Каждый MAX() читается из своего индекса: ix_logs_timestamp / ix_logs_user_ts и первичный ключ / ix_logs_user_id """
+    query = select(func.max(Log.timestamp), func.max(Log.id))
+    if user_id is not None:
+        query = query.where(Log.user_id == user_id)
+    result = await db.execute(query)
+    last_ts, last_id = result.one()
+    key = f"{request.url.path}?{request.url.query}:{last_ts}:{last_id}"
+    return f'"{hashlib.blake2b(key.encode(), digest_size=8).hexdigest()}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """ Проверка заголовка If-None-Match """
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))
+
+
+def as_utc(value: Optional[datetime]):
+    """ Даты без часового пояса (например, 2024-01-01) считаются датами в UTC """
+    if value and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def check_cursor(before_ts: Optional[datetime], before_id: Optional[int]):
+    """ Курсор задаётся только парой before_ts и before_id; before_ts без часового пояса считается UTC """
+    if (before_ts is None) != (before_id is None):
+        raise HTTPException(status_code=400, detail="Параметры before_ts и before_id передаются вместе")
+    return as_utc(before_ts)
+
+
+def select_fields(fields: Optional[str]):
+    """ SELECT только нужных колонок вместо всей строки логов """
+    if not fields:
+        return select(*LOG_FIELDS.values())
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    unknown = names - LOG_FIELDS.keys()
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные поля: {', '.join(sorted(unknown))}")
+    names |= {'id', 'timestamp'}
+    return select(*(column for name, column in LOG_FIELDS.items() if name in names))
+
+
+def check_date_range(start_date: Optional[datetime], end_date: Optional[datetime]):
+    """ Ограничение ширины интервала дат, чтобы не выбирать логи за годы """
+    start_date, end_date = as_utc(start_date), as_utc(end_date)
+    if start_date and end_date and end_date - start_date > MAX_DATE_RANGE:
+        raise HTTPException(status_code=400, detail=f"Интервал дат не может превышать {MAX_DATE_RANGE.days} дней")
+    return start_date, end_date
+
+
+@app.get('/logs', response_model=None, responses={200: {'model': LogPage}}, summary="Получить все логи",
          description="Возвращает список всех запросов пользователей с поддержкой пагинации и фильтрации по дате.")
-def get_logs(
-    offset: int = Query(0, ge=0, description="Количество пропущенных записей"),
+async def get_logs(
+    request: Request,
+    before_ts: Optional[datetime] = Query(None, description="Время последней записи предыдущей страницы (next_cursor.timestamp)"),
+    before_id: Optional[int] = Query(None, description="ID последней записи предыдущей страницы (next_cursor.id)"),
     limit: int = Query(10, ge=1, le=100, description="Количество возвращаемых записей"),
     start_date: Optional[datetime] = Query(None, description="Начальная дата в формате YYYY-MM-DD"),
-    end_date: Optional[datetime] = Query(None, description="Конечная дата в формате YYYY-MM-DD"),
-    db: Session = Depends(get_db)
+    end_date: Optional[datetime] = Query(None, description="Конечная дата в формате YYYY-MM-DD (не включается)"),
+    fields: Optional[str] = Query(None, description="Поля записи через запятую, например id,timestamp,command. По умолчанию все поля"),
+    db: AsyncSession = Depends(get_db)
 ):
+    before_ts = check_cursor(before_ts, before_id)
+    start_date, end_date = check_date_range(start_date, end_date)
+    query = select_fields(fields)
     try:
-        query = db.query(Log)
+        etag = await page_etag(db, request)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': CACHE_CONTROL})
         if start_date:
-            query = query.filter(Log.timestamp >= start_date)
+            query = query.where(Log.timestamp >= start_date)
         if end_date:
-            query = query.filter(Log.timestamp <= end_date)
-        logs = query.order_by(desc(Log.timestamp)).offset(offset).limit(limit).all()
-        logger.info(f"Получен список логов: offset={offset}, limit={limit}, start_date={start_date}, end_date={end_date}")
-        return logs
+            query = query.where(Log.timestamp < end_date)
+        page = await paginate(db, query, before_ts, before_id, limit)
+        logger.info("Получен список логов: before_ts=%s, before_id=%s, limit=%s, start_date=%s, end_date=%s", before_ts, before_id, limit, start_date, end_date)
+        return page_response(page, etag)
     except Exception as e:
-        logger.error(f"Ошибка при получении логов: {e}")
+        logger.error("Ошибка при получении логов: %s", e)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
 
-@app.get('/logs/{user_id}', response_model=List[LogSchema], summary="Получить логи пользователя",
+@app.get('/logs/{user_id}', response_model=None, responses={200: {'model': LogPage}}, summary="Получить логи пользователя",
          description="Возвращает список запросов конкретного пользователя с поддержкой пагинации и фильтрации по дате.")
-def get_user_logs(
+async def get_user_logs(
     user_id: int,
-    offset: int = Query(0, ge=0, description="Количество пропущенных записей"),
+    request: Request,
+    before_ts: Optional[datetime] = Query(None, description="Время последней записи предыдущей страницы (next_cursor.timestamp)"),
+    before_id: Optional[int] = Query(None, description="ID последней записи предыдущей страницы (next_cursor.id)"),
     limit: int = Query(10, ge=1, le=100, description="Количество возвращаемых записей"),
     start_date: Optional[datetime] = Query(None, description="Начальная дата в формате YYYY-MM-DD"),
-    end_date: Optional[datetime] = Query(None, description="Конечная дата в формате YYYY-MM-DD"),
-    db: Session = Depends(get_db)
+    end_date: Optional[datetime] = Query(None, description="Конечная дата в формате YYYY-MM-DD (не включается)"),
+    fields: Optional[str] = Query(None, description="Поля записи через запятую, например id,timestamp,command. По умолчанию все поля"),
+    db: AsyncSession = Depends(get_db)
 ):
+    before_ts = check_cursor(before_ts, before_id)
+    start_date, end_date = check_date_range(start_date, end_date)
+    query = select_fields(fields).where(Log.user_id == user_id)
     try:
-        query = db.query(Log).filter(Log.user_id == user_id)
+        etag = await page_etag(db, request, user_id)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': CACHE_CONTROL})
         if start_date:
-            query = query.filter(Log.timestamp >= start_date)
+            query = query.where(Log.timestamp >= start_date)
         if end_date:
-            query = query.filter(Log.timestamp <= end_date)
-        logs = query.order_by(desc(Log.timestamp)).offset(offset).limit(limit).all()
-        if not logs:
-            logger.warning(f"Логи не найдены для пользователя ID={user_id}")
+            query = query.where(Log.timestamp < end_date)
+        page = await paginate(db, query, before_ts, before_id, limit)
+        if not page.items and before_id is None:
+            logger.warning("Логи не найдены для пользователя ID=%s", user_id)
             raise HTTPException(status_code=404, detail="Логи не найдены для данного пользователя")
-        logger.info(f"Получен список логов для пользователя ID={user_id}: offset={offset}, limit={limit}, start_date={start_date}, end_date={end_date}")
-        return logs
+        logger.info("Получен список логов для пользователя ID=%s: before_ts=%s, before_id=%s, limit=%s, start_date=%s, end_date=%s", user_id, before_ts, before_id, limit, start_date, end_date)
+        return page_response(page, etag)
     except HTTPException as he:
         raise he
     except Exception as e:
-        logger.error(f"Ошибка при получении логов пользователя ID={user_id}: {e}")
+        logger.error("Ошибка при получении логов пользователя ID=%s: %s", user_id, e)
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
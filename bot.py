@@ -1,14 +1,27 @@
 import os
+import asyncio
+import functools
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+import hishel
 import httpx
+import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
 from telegram import Update
 from telegram.ext import CommandHandler, CallbackContext, ApplicationBuilder
 
-from sqlalchemy import create_engine, Column, Integer, BigInteger, String, Text, DateTime, func
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from dotenv import load_dotenv
-from aiocache import cached, Cache
+from aiocache import cached_stampede, Cache
 from aiocache.serializers import JsonSerializer
+from models import Base, Log, UserSetting, ENGINE_OPTIONS, async_database_url
 
 load_dotenv()
 
@@ -19,32 +32,108 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+def setup_log_queue():
+    """ Перенос записи логов в отдельный поток, чтобы write() не блокировал event loop """
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    listener.start()
+    return listener
+
+
 # Настройка БД
 DATABASE_URL = os.getenv('DATABASE_URL')
-engine = create_engine(DATABASE_URL)
-Base = declarative_base()
+engine = create_async_engine(async_database_url(DATABASE_URL), **ENGINE_OPTIONS)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+# Сессии только для чтения: AUTOCOMMIT без BEGIN/COMMIT, соединения берутся из того же пула
+SessionRO = async_sessionmaker(engine.execution_options(isolation_level='AUTOCOMMIT'), autoflush=False)
 
+# Очередь логов запросов: handler'ы только кладут запись, в БД она попадает пачкой из log_writer
+LOG_QUEUE: asyncio.Queue[dict] = asyncio.Queue(maxsize=10_000)
+LOG_BATCH_SIZE = 200
 
-class Log(Base):
-    __tablename__ = 'logs'
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(BigInteger, nullable=False)
-    command = Column(String, nullable=False)
-    timestamp = Column(DateTime(timezone=True), server_default=func.now())
-    response = Column(Text)
+# Кэш установленных городов пользователей: /weather без аргументов не ходит в БД для активных пользователей
+USER_CITY_CACHE = TTLCache(maxsize=100_000, ttl=300)
 
+# Ограничение частоты команд: не больше RATE_LIMIT запросов за RATE_PERIOD секунд на пользователя
+RATE_LIMIT = 5
+RATE_PERIOD = 60
+# Лимитер удаляется только после долгого простоя пользователя, когда его ведро уже давно опустело,
+# иначе сброс по TTL обнулял бы лимит активным пользователям
+USER_LIMITERS = TTLCache(maxsize=100_000, ttl=RATE_PERIOD * 10)
 
-class UserSetting(Base):
-    __tablename__ = 'user_settings'
-    user_id = Column(BigInteger, primary_key=True, index=True)
-    city = Column(String, nullable=False)
+OPENWEATHERMAP_API_KEY = os.getenv('OPENWEATHERMAP_API_KEY')
+REDIS_HOST = os.getenv('REDIS_HOST') or 'localhost'
+REDIS_PORT = int(os.getenv('REDIS_PORT') or 6379)
+WEATHER_URL = '/data/2.5/weather'
+MAX_WEATHER_RESPONSE_SIZE = 64 * 1024  # Ответ OpenWeatherMap занимает около 1 КБ
 
 
-Base.metadata.create_all(bind=engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+class OptionalCacheTransport(hishel.AsyncCacheTransport):
+    """ HTTP-кэш, без которого запросы продолжают работать: при ошибке Redis запрос уходит напрямую """
 
-OPENWEATHERMAP_API_KEY = os.getenv('OPENWEATHERMAP_API_KEY')
-WEATHER_URL = 'https://api.openweathermap.org/data/2.5/weather'
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            return await super().handle_async_request(request)
+        except redis.RedisError as e:
+            logger.error("HTTP-кэш недоступен, запрос без кэша: %s", e)
+            return await self._transport.handle_async_request(request)
+
+
+# Общий клиент с пулом keep-alive соединений, чтобы не делать TCP/TLS-рукопожатие на каждый запрос.
+# HTTP-кэш в Redis: повторные запросы проверяются условным GET и получают 304 без тела ответа.
+# Ответ хранится дольше TTL кэша get_weather (600 с), иначе к моменту промаха там уже нечего ревалидировать
+HTTP_CACHE_TTL = 24 * 60 * 60
+WEATHER_CLIENT = httpx.AsyncClient(
+    base_url='https://api.openweathermap.org',
+    timeout=httpx.Timeout(10.0, connect=2.0),
+    transport=OptionalCacheTransport(
+        transport=httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30),
+        ),
+        controller=hishel.Controller(cacheable_methods=['GET'], allow_stale=True),
+        # Короткие таймауты без повторов: недоступный Redis не должен задерживать запрос погоды
+        storage=hishel.AsyncRedisStorage(
+            client=redis.Redis(
+                host=REDIS_HOST, port=REDIS_PORT,
+                socket_connect_timeout=1, socket_timeout=1, retry=Retry(NoBackoff(), 0),
+            ),
+            ttl=HTTP_CACHE_TTL,
+        ),
+    ),
+)
+
+
+# Шаблон ответа /weather, ключи совпадают с ключами словаря из get_weather
+WEATHER_TEMPLATE = (
+    "🌤 *Погода в {город}*\n"
+    "🌡 *Температура:* {температура}°C\n"
+    "🌡 *Ощущается как:* {ощущается как}°C\n"
+    "☁️ *Описание:* {описание}\n"
+    "💧 *Влажность:* {влажность}%\n"
+    "💨 *Скорость ветра:* {скорость ветра} м/с\n\n"
+)
+
+
+def rate_limited(handler):
+    """ Отклоняет команду, если пользователь исчерпал лимит, до обращения к БД и OpenWeatherMap """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext):
+        user_id = update.effective_user.id
+        limiter = USER_LIMITERS.get(user_id)
+        if limiter is None:
+            limiter = AsyncLimiter(RATE_LIMIT, RATE_PERIOD)
+        # Повторная запись продлевает TTL: TTLCache отсчитывает время от последней вставки
+        USER_LIMITERS[user_id] = limiter
+        if not limiter.has_capacity():
+            logger.warning("Пользователь %s превысил лимит запросов", user_id)
+            await update.message.reply_text("⏳ Слишком много запросов. Попробуйте через минуту.")
+            return
+        await limiter.acquire()
+        return await handler(update, context)
+    return wrapper
 
 
 async def help_command(update: Update, context: CallbackContext):
@@ -62,10 +151,13 @@ async def help_command(update: Update, context: CallbackContext):
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
 
-# Настройка кэша (in-memory)
-@cached(ttl=600, cache=Cache.MEMORY, serializer=JsonSerializer())  # Кэш на 10 минут
-async def get_weather(city: str):
-    """ Функция получения погоды с кэшированием """
+def weather_cache_key(func, city: str):
+    """ Ключ кэша не зависит от регистра и пробелов: "Moscow", "moscow" и " Moscow " совпадают """
+    return city.lower().strip()
+
+
+async def fetch_weather(city: str):
+    """ Запрос погоды у OpenWeatherMap без кэша aiocache """
     params = {
         'q': city,
         'appid': OPENWEATHERMAP_API_KEY,
@@ -73,154 +165,225 @@ async def get_weather(city: str):
         'lang': 'ru'
     }
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        try:
-            response = await client.get(WEATHER_URL, params=params)
-            response.raise_for_status()
-            data = response.json()
-            weather = {
-                'город': data['name'],
-                'температура': data['main']['temp'],
-                'ощущается как': data['main']['feels_like'],
-                'описание': data['weather'][0]['description'],
-                'влажность': data['main']['humidity'],
-                'скорость ветра': data['wind']['speed']
-            }
-            logger.info(f"Получены данные о погоде для города: {city}")
-            return weather
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Ошибка HTTP: {e.response.status_code} - {e.response.text}")
-            return None
-        except httpx.RequestError as e:
-            logger.error(f"Ошибка при запросе погоды: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Произошла ошибка: {e}")
+    try:
+        response = await WEATHER_CLIENT.get(WEATHER_URL, params=params)
+        response.raise_for_status()
+        if len(response.content) > MAX_WEATHER_RESPONSE_SIZE:
+            logger.error("Слишком большой ответ OpenWeatherMap: %s байт", len(response.content))
             return None
+        data = response.json()
+        weather = {
+            'город': data['name'],
+            'температура': data['main']['temp'],
+            'ощущается как': data['main']['feels_like'],
+            'описание': data['weather'][0]['description'],
+            'влажность': data['main']['humidity'],
+            'скорость ветра': data['wind']['speed']
+        }
+        logger.info("Получены данные о погоде для города: %s", city)
+        return weather
+    except httpx.HTTPStatusError as e:
+        logger.error("Ошибка HTTP: %s - %s", e.response.status_code, e.response.text)
+        return None
+    except httpx.RequestError as e:
+        logger.error("Ошибка при запросе погоды: %s", e)
+        return None
+    except Exception as e:
+        logger.error("Произошла ошибка: %s", e)
+        return None
+
+
+# Настройка кэша (Redis, общий для всех экземпляров бота).
+# lease объединяет одновременные запросы одного города только внутри процесса: ожидание
+# освобождения блокировки идёт через локальный asyncio.Event, другие экземпляры бота
+# по истечении lease сами запрашивают OpenWeatherMap
+@cached_stampede(
+    lease=5,
+    ttl=600,  # Кэш на 10 минут
+    cache=Cache.REDIS,
+    endpoint=REDIS_HOST,
+    port=REDIS_PORT,
+    # Как и у HTTP-кэша: при недоступном Redis быстро падаем в запрос без кэша
+    timeout=1,
+    create_connection_timeout=1,
+    connection_pool_kwargs={'retry': Retry(NoBackoff(), 0)},
+    namespace='weather',
+    serializer=JsonSerializer(),
+    key_builder=weather_cache_key,
+    skip_cache_func=lambda weather: weather is None,
+)
+async def get_cached_weather(city: str):
+    """ Функция получения погоды с кэшированием """
+    return await fetch_weather(city)
+
+
+async def get_weather(city: str):
+    """ Получение погоды: при недоступном Redis запрос идёт напрямую, без кэша.
+    WEATHER_CLIENT сам переживает отказ Redis (OptionalCacheTransport), поэтому прямой запрос доходит до OpenWeatherMap """
+    try:
+        return await get_cached_weather(city)
+    except (redis.RedisError, asyncio.TimeoutError) as e:
+        logger.error("Кэш погоды недоступен, запрос без кэша: %s", e)
+        return await fetch_weather(city)
+
+
+async def get_user_city(user_id: int):
+    """ Получение установленного города пользователя с кэшированием """
+    city = USER_CITY_CACHE.get(user_id)
+    if city is None:
+        async with SessionRO() as db:
+            setting = await db.get(UserSetting, user_id)
+        if setting:
+            city = USER_CITY_CACHE[user_id] = setting.city
+    return city
 
 
+@rate_limited
 async def weather_command(update: Update, context: CallbackContext):
     """ Обработчик команды /weather """
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} вызвал команду /weather")
+    logger.info("Пользователь %s вызвал команду /weather", user_id)
 
-    # Получение установленного города из базы данных
-    db = SessionLocal()
-    try:
-        setting = db.query(UserSetting).filter(UserSetting.user_id == user_id).first()
-        logger.info(f"Настройки пользователя {user_id} получены: {setting.city if setting else 'Город не установлен'}")
-    except Exception as e:
-        logger.error(f"Ошибка при получении настроек пользователя {user_id}: {e}")
-        await update.message.reply_text("Произошла ошибка при получении настроек. Пожалуйста, попробуйте позже.")
-        return
-    finally:
-        db.close()
-
-    # Определение города либо из аргументов команды, либо из настроек пользователя
+    # Определение города либо из аргументов команды, либо из настроек пользователя.
+    # В настройки обращаемся только если город не указан в команде
     if len(context.args) == 0:
-        if setting and setting.city:
-            city = setting.city
-            logger.info(f"Использование установленного города для пользователя {user_id}: {city}")
+        try:
+            user_city = await get_user_city(user_id)
+            logger.info("Настройки пользователя %s получены: %s", user_id, user_city or 'Город не установлен')
+        except Exception as e:
+            logger.error("Ошибка при получении настроек пользователя %s: %s", user_id, e)
+            await update.message.reply_text("Произошла ошибка при получении настроек. Пожалуйста, попробуйте позже.")
+            return
+
+        if user_city:
+            city = user_city
+            logger.info("Использование установленного города для пользователя %s: %s", user_id, city)
         else:
             message = "❓ Укажите город.\nПример: /weather Москва"
             await update.message.reply_text(message)
-            logger.info(f"Пользователь {user_id} не указал город и не имеет установленного города.")
+            logger.info("Пользователь %s не указал город и не имеет установленного города.", user_id)
             return
     else:
         city = ' '.join(context.args)
-        logger.info(f"Пользователь {user_id} запрашивает погоду для города: {city}")
+        logger.info("Пользователь %s запрашивает погоду для города: %s", user_id, city)
 
     # Получение данных о погоде
     weather = await get_weather(city)
     if weather and weather.get('город'):
-        message = (
-            f"🌤 *Погода в {weather['город']}*\n"
-            f"🌡 *Температура:* {weather['температура']}°C\n"
-            f"🌡 *Ощущается как:* {weather['ощущается как']}°C\n"
-            f"☁️ *Описание:* {weather['описание'].capitalize()}\n"
-            f"💧 *Влажность:* {weather['влажность']}%\n"
-            f"💨 *Скорость ветра:* {weather['скорость ветра']} м/с\n\n"
-        )
+        weather['описание'] = weather['описание'].capitalize()
+        message = WEATHER_TEMPLATE.format_map(weather)
     else:
         message = "❌ Не удалось получить данные о погоде. Проверьте название города."
 
-    logger.info(f"Ответ пользователю {user_id}: {message}")
+    logger.info("Ответ пользователю %s: %s", user_id, message)
 
     # Отправка ответа пользователю
     try:
         await update.message.reply_text(message, parse_mode='Markdown')
-        logger.info(f"Сообщение успешно отправлено пользователю {user_id}")
+        logger.info("Сообщение успешно отправлено пользователю %s", user_id)
     except Exception as e:
-        logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+        logger.error("Ошибка при отправке сообщения пользователю %s: %s", user_id, e)
         return
 
-    # Логирование запроса в базу данных
-    db = SessionLocal()
+    # Логирование запроса в базу данных (запись выполняет фоновая задача log_writer)
     try:
-        log_entry = Log(
-            user_id=user_id,
-            command=update.message.text,
-            response=message
-        )
-        db.add(log_entry)
-        db.commit()
-        logger.info(f"Запрос пользователя {user_id} успешно залогирован.")
-    except Exception as e:
-        logger.error(f"Ошибка при логировании запроса пользователя {user_id}: {e}")
-    finally:
-        db.close()
+        LOG_QUEUE.put_nowait({
+            'user_id': user_id,
+            'command': update.message.text,
+            'timestamp': datetime.now(timezone.utc),
+            'response': message,
+        })
+    except asyncio.QueueFull:
+        logger.error("Очередь логов переполнена, запрос пользователя %s не залогирован.", user_id)
 
 
+@rate_limited
 async def set_city(update: Update, context: CallbackContext):
     """ Обработчик команды /setcity """
     user_id = update.effective_user.id
     if len(context.args) == 0:
         await update.message.reply_text("❓ Пожалуйста, укажите город.\nПример: /setcity Москва")
-        logger.info(f"Пользователь {user_id} вызвал /setcity без указания города.")
+        logger.info("Пользователь %s вызвал /setcity без указания города.", user_id)
         return
     city = ' '.join(context.args)
-    logger.info(f"Пользователь {user_id} устанавливает город: {city}")
-    db = SessionLocal()
+    logger.info("Пользователь %s устанавливает город: %s", user_id, city)
+    # Один атомарный UPSERT вместо SELECT + INSERT/UPDATE
+    stmt = pg_insert(UserSetting).values(user_id=user_id, city=city).on_conflict_do_update(
+        index_elements=[UserSetting.user_id],
+        set_={'city': city},
+    )
     try:
-        setting = db.query(UserSetting).filter(UserSetting.user_id == user_id).first()
-        if setting:
-            setting.city = city
-            logger.info(f"Пользователь {user_id} изменил установленный город на: {city}")
-        else:
-            setting = UserSetting(user_id=user_id, city=city)
-            db.add(setting)
-            logger.info(f"Пользователь {user_id} установил новый город: {city}")
-        db.commit()
+        async with SessionLocal() as db:
+            await db.execute(stmt)
+            await db.commit()
+        USER_CITY_CACHE.pop(user_id, None)
+        logger.info("Пользователь %s установил город: %s", user_id, city)
     except Exception as e:
-        logger.error(f"Ошибка при установке города для пользователя {user_id}: {e}")
+        logger.error("Ошибка при установке города для пользователя %s: %s", user_id, e)
         await update.message.reply_text("❌ Произошла ошибка при установке города. Пожалуйста, попробуйте позже.")
         return
-    finally:
-        db.close()
     await update.message.reply_text(f"✅ Город установлен на {city}")
 
 
+@rate_limited
 async def get_city(update: Update, context: CallbackContext):
     """ Обработчик команды /getcity """
     user_id = update.effective_user.id
-    logger.info(f"Пользователь {user_id} вызвал команду /getcity")
-    db = SessionLocal()
+    logger.info("Пользователь %s вызвал команду /getcity", user_id)
     try:
-        setting = db.query(UserSetting).filter(UserSetting.user_id == user_id).first()
-        if setting:
-            message = f"📍 Ваш установленный город: {setting.city}"
-            logger.info(f"Пользователь {user_id} имеет установленный город: {setting.city}")
+        city = await get_user_city(user_id)
+        if city:
+            message = f"📍 Ваш установленный город: {city}"
+            logger.info("Пользователь %s имеет установленный город: %s", user_id, city)
         else:
             message = "❌ Город не установлен. Используйте /setcity <город> для установки."
-            logger.info(f"Пользователь {user_id} не имеет установленного города.")
+            logger.info("Пользователь %s не имеет установленного города.", user_id)
     except Exception as e:
-        logger.error(f"Ошибка при получении настроек пользователя {user_id}: {e}")
+        logger.error("Ошибка при получении настроек пользователя %s: %s", user_id, e)
         message = "❌ Произошла ошибка при получении настроек. Пожалуйста, попробуйте позже."
-    finally:
-        db.close()
     await update.message.reply_text(message)
 
 
+async def write_logs(batch: list[dict]):
+    """ Запись пачки логов одним INSERT и одним коммитом """
+    try:
+        async with SessionLocal() as db:
+            await db.execute(insert(Log), batch)
+            await db.commit()
+        logger.info("Залогировано запросов: %s", len(batch))
+    except Exception as e:
+        logger.error("Ошибка при логировании %s запросов: %s", len(batch), e)
+
+
+async def log_writer():
+    """ Фоновая задача: забирает логи из очереди и пишет их в БД пачками """
+    while True:
+        batch = [await LOG_QUEUE.get()]
+        while len(batch) < LOG_BATCH_SIZE and not LOG_QUEUE.empty():
+            batch.append(LOG_QUEUE.get_nowait())
+        await write_logs(batch)
+        for _ in batch:
+            LOG_QUEUE.task_done()
+
+
+async def on_startup(application):
+    """ Запуск записи логов при запуске бота """
+    # Схему создают scripts.py и migrations/; create_all только для локальной разработки
+    if os.getenv('AUTO_CREATE_TABLES') == '1':
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    application.bot_data['log_writer'] = asyncio.create_task(log_writer())
+
+
+async def on_shutdown(application):
+    """ Запись оставшихся логов и закрытие HTTP-клиента при остановке бота """
+    log_writer_task = application.bot_data.pop('log_writer', None)
+    if log_writer_task:
+        await LOG_QUEUE.join()
+        log_writer_task.cancel()
+    await WEATHER_CLIENT.aclose()
+
+
 def main():
     TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 
@@ -228,15 +391,19 @@ def main():
         logger.error("TELEGRAM_TOKEN не задан в переменных окружения.")
         return
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    application = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("weather", weather_command))
     application.add_handler(CommandHandler("setcity", set_city))
     application.add_handler(CommandHandler("getcity", get_city))
 
     # Запускаю бота
+    listener = setup_log_queue()
     logger.info("🔄 Запуск бота...")
-    application.run_polling()
+    try:
+        application.run_polling()
+    finally:
+        listener.stop()
 
 
 if __name__ == '__main__':
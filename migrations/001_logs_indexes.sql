@@ -0,0 +1,5 @@
+-- Индексы для выборки логов в API (/logs и /logs/{user_id}).
+-- CONCURRENTLY не блокирует запись в таблицу, поэтому скрипт нельзя выполнять внутри транзакции:
+--   psql "$DATABASE_URL" -f migrations/001_logs_indexes.sql
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_logs_timestamp ON logs (timestamp);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_logs_user_ts ON logs (user_id, timestamp DESC);
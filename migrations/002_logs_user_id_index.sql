@@ -0,0 +1,4 @@
+-- Индекс для ETag в /logs/{user_id}: MAX(id) пользователя читается из индекса, а не из всех его записей.
+-- CONCURRENTLY не блокирует запись в таблицу, поэтому скрипт нельзя выполнять внутри транзакции:
+--   psql "$DATABASE_URL" -f migrations/002_logs_user_id_index.sql
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_logs_user_id ON logs (user_id, id);
@@ -0,0 +1,44 @@
+from sqlalchemy import make_url, Column, Integer, BigInteger, String, Text, DateTime, Index, func
+from sqlalchemy.orm import declarative_base
+
+
+def async_database_url(url: str):
+    """ Подставляет асинхронный драйвер asyncpg в обычный postgresql:// URL """
+    url = make_url(url)
+    if url.drivername in ('postgresql', 'postgresql+psycopg2'):
+        url = url.set(drivername='postgresql+asyncpg')
+    return url
+
+
+# Пул соединений под всплески трафика; statement_timeout не даёт зависшему запросу занять соединение надолго
+ENGINE_OPTIONS = {
+    'pool_size': 20,
+    'max_overflow': 40,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'connect_args': {'server_settings': {'statement_timeout': '5000'}},
+}
+
+Base = declarative_base()
+
+
+class Log(Base):
+    __tablename__ = 'logs'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(BigInteger, nullable=False)
+    command = Column(String, nullable=False)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    response = Column(Text)
+
+    # Составные индексы: выборка логов пользователя, отсортированных по времени,
+    # и MAX(id) пользователя для ETag без чтения всех его записей
+    __table_args__ = (
+        Index('ix_logs_user_ts', 'user_id', timestamp.desc()),
+        Index('ix_logs_user_id', 'user_id', 'id'),
+    )
+
+
+class UserSetting(Base):
+    __tablename__ = 'user_settings'
+    user_id = Column(BigInteger, primary_key=True, index=True)
+    city = Column(String, nullable=False)
@@ -1,42 +1,58 @@
-import psycopg2
-from psycopg2 import sql
-
-def create_database(db_name):
-    connection = psycopg2.connect(user="your_username", password="your_password", host="localhost")
-    connection.autocommit = True
-    cursor = connection.cursor()
-
-    # Создаем базу данных
-    cursor.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(db_name)))
-    print(f"Database '{db_name}' created successfully!")
-
-    cursor.close()
-    connection.close()
-
-def create_table(db_name):
-    connection = psycopg2.connect(user="your_username", password="your_password", host="localhost", database=db_name)
-    cursor = connection.cursor()
-
-    # Создаем таблицу logs
-    create_table_query = """
-    CREATE TABLE logs (
-        id SERIAL PRIMARY KEY,
-        user_id BIGINT NOT NULL,
-        command TEXT NOT NULL,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        response TEXT
-    );
-    """
-    cursor.execute(create_table_query)
-    print("Table 'logs' created successfully!")
-
-    cursor.close()
-    connection.close()
+import os
+import psycopg
+from psycopg import sql
+from psycopg.conninfo import conninfo_to_dict
+from sqlalchemy import make_url
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Все DDL идемпотентны: скрипт можно запускать повторно при каждом деплое
+CREATE_TABLES_QUERY = """
+CREATE TABLE IF NOT EXISTS logs (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    command TEXT NOT NULL,
+    timestamp TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_logs_timestamp ON logs (timestamp);
+CREATE INDEX IF NOT EXISTS ix_logs_user_ts ON logs (user_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS ix_logs_user_id ON logs (user_id, id);
+CREATE TABLE IF NOT EXISTS user_settings (
+    user_id BIGINT PRIMARY KEY,
+    city VARCHAR NOT NULL
+);
+"""
+
+
+def psycopg_url(url: str) -> str:
+    """ URL в формате SQLAlchemy (postgresql+psycopg2://) приводится к postgresql://, который понимает psycopg """
+    return make_url(url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+
+def create_database():
+    database_url = psycopg_url(os.environ['DATABASE_URL'])
+    db_name = conninfo_to_dict(database_url)['dbname']
+
+    # Создаем базу данных, если её ещё нет (CREATE DATABASE не поддерживает IF NOT EXISTS)
+    with psycopg.connect(psycopg_url(os.environ['DATABASE_URL_ADMIN']), autocommit=True) as connection:
+        exists = connection.execute("SELECT 1 FROM pg_database WHERE datname = %s", (db_name,)).fetchone()
+        if exists:
+            print(f"Database '{db_name}' already exists")
+        else:
+            connection.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(db_name)))
+            print(f"Database '{db_name}' created successfully!")
+
+    # Создаем таблицы logs, user_settings и индексы
+    with psycopg.connect(database_url) as connection:
+        connection.execute(CREATE_TABLES_QUERY)
+    print("Tables 'logs' and 'user_settings' are ready!")
+
 
 def main():
-    db_name = 'weather_bot_db'
-    create_database(db_name)
-    create_table(db_name)
+    create_database()
+
 
 if __name__ == "__main__":
     main()